@@ -17,14 +17,20 @@ import logging
 import sqlite3
 import sys
 import time
+from calendar import monthrange
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import contextmanager
 from datetime import datetime
-from typing import Generator, Optional
+from functools import lru_cache
+from math import isfinite
+from typing import Any, Generator, Iterator, NamedTuple, Optional, TextIO
 
 import json
 
 import requests
 import schedule
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ──────────────────────────────────────────────────────────────────────────────
 # CONFIGURATION — edit this section to match your setup
@@ -75,11 +81,21 @@ API_ERRORS: frozenset[str] = frozenset(
         "There is no data.",
     }
 )
+_API_ERRORS_B: frozenset[bytes] = frozenset(e.encode() for e in API_ERRORS)
 
 # ──────────────────────────────────────────────────────────────────────────────
 # DEVICE LOADER
 # ──────────────────────────────────────────────────────────────────────────────
 
+try:  # optional: faster JSON decoding for the device file
+    import orjson
+
+    def _jload(fh: TextIO) -> Any:
+        return orjson.loads(fh.read())
+except ImportError:
+    _jload = json.load
+
+
 def load_devices() -> list[dict]:
     """Return device list from DEVICES_FILE (JSON) or fall back to DEVICES."""
     if DEVICES_FILE is None:
@@ -87,7 +103,7 @@ def load_devices() -> list[dict]:
 
     try:
         with open(DEVICES_FILE, encoding="utf-8") as fh:
-            data = json.load(fh)
+            data = _jload(fh)
         if not isinstance(data, list):
             raise ValueError("Top-level JSON value must be a list.")
         return data
@@ -129,13 +145,31 @@ log = _setup_logging()
 # DATABASE
 # ──────────────────────────────────────────────────────────────────────────────
 
+# Hot-path statements, kept as module constants so every download reuses the
+# same string and hits the connection's prepared-statement cache.
+_SQL_INS_MEAS = (
+    "INSERT INTO measurements (device_id, timestamp, raw_line, field_values) "
+    "VALUES (?, ?, ?, ?) ON CONFLICT (device_id, timestamp) DO NOTHING"
+)
+
+
 @contextmanager
 def db_conn() -> Generator[sqlite3.Connection, None, None]:
     """Open a connection, commit on success, roll back on error, always close."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, cached_statements=256)
     conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON")
-    conn.execute("PRAGMA journal_mode = WAL")
+    conn.executescript(
+        """
+        PRAGMA foreign_keys = ON;
+        PRAGMA synchronous = NORMAL;
+        PRAGMA cache_size = -20000;
+        PRAGMA temp_store = MEMORY;
+        PRAGMA mmap_size = 268435456;
+        PRAGMA busy_timeout = 5000;
+        PRAGMA wal_autocheckpoint = 1000;
+        PRAGMA journal_size_limit = 6144000;
+        """
+    )
     try:
         yield conn
         conn.commit()
@@ -148,6 +182,8 @@ def db_conn() -> Generator[sqlite3.Connection, None, None]:
 
 def init_db() -> None:
     with db_conn() as conn:
+        # WAL is persistent in the database file, so it only needs setting once
+        conn.execute("PRAGMA journal_mode = WAL")
         conn.executescript(
             """
             CREATE TABLE IF NOT EXISTS devices (
@@ -161,16 +197,11 @@ def init_db() -> None:
                 device_id  TEXT    NOT NULL REFERENCES devices(device_id),
                 timestamp  TEXT    NOT NULL,
                 raw_line   TEXT    NOT NULL,
+                -- JSON object {field_name: value} for this record
+                field_values TEXT  NOT NULL DEFAULT '{}',
                 UNIQUE (device_id, timestamp)
             );
 
-            CREATE TABLE IF NOT EXISTS measurement_fields (
-                measurement_id INTEGER NOT NULL REFERENCES measurements(id),
-                field_name     TEXT    NOT NULL,
-                field_value    REAL,
-                PRIMARY KEY (measurement_id, field_name)
-            );
-
             CREATE TABLE IF NOT EXISTS download_log (
                 id            INTEGER PRIMARY KEY AUTOINCREMENT,
                 device_id     TEXT    NOT NULL,
@@ -181,14 +212,61 @@ def init_db() -> None:
             );
             """
         )
+        _migrate_measurement_fields(conn)
     log.debug("Database ready: %s", DB_PATH)
 
 
-def _upsert_device(conn: sqlite3.Connection, device_id: str, alias: str) -> None:
+def _migrate_measurement_fields(conn: sqlite3.Connection) -> None:
+    """Fold the old per-field measurement_fields table into measurements.field_values."""
+    columns = {r["name"] for r in conn.execute("PRAGMA table_info(measurements)")}
+    if "field_values" not in columns:
+        conn.execute(
+            "ALTER TABLE measurements ADD COLUMN field_values TEXT NOT NULL DEFAULT '{}'"
+        )
+
+    legacy = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'measurement_fields'"
+    ).fetchone()
+    if legacy is None:
+        return
+
+    log.info("Migrating measurement_fields into measurements.field_values …")
     conn.execute(
-        "INSERT OR IGNORE INTO devices (device_id, alias) VALUES (?, ?)",
-        (device_id, alias),
+        """
+        UPDATE measurements
+        SET    field_values = (
+                   -- the REAL column may hold ±Inf, which is not valid JSON
+                   SELECT json_group_object(
+                              field_name,
+                              CASE WHEN abs(field_value) > 1.7976931348623157e308
+                                   THEN NULL ELSE field_value END
+                          )
+                   FROM   measurement_fields
+                   WHERE  measurement_id = measurements.id
+               )
+        WHERE  id IN (SELECT measurement_id FROM measurement_fields)
+        """
     )
+    conn.execute("DROP TABLE measurement_fields")
+
+
+def _register_devices(devices: list[dict]) -> None:
+    """
+    Insert any devices not yet in the devices table, in one transaction.
+
+    Malformed entries are skipped here; they fail and get logged in their own
+    download instead of aborting the whole run.
+    """
+    rows = [
+        (d["device_id"], d["alias"])
+        for d in devices
+        if isinstance(d, dict) and "device_id" in d and "alias" in d
+    ]
+    with db_conn() as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO devices (device_id, alias) VALUES (?, ?)",
+            rows,
+        )
 
 
 def _log_run(
@@ -210,47 +288,104 @@ def _log_run(
 # API & PARSING
 # ──────────────────────────────────────────────────────────────────────────────
 
-def fetch_raw(device_id: str, lines: int = LINES, zoom: int = ZOOM) -> str:
-    """Download raw text from the API. Raises on HTTP or network errors."""
+def _make_session() -> requests.Session:
+    """Session with pooled keep-alive connections and retries for the API host."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=Retry(total=3, backoff_factor=0.5),
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+_SESSION = _make_session()
+
+
+def fetch_lines(device_id: str, lines: int = LINES, zoom: int = ZOOM) -> Iterator[str]:
+    """
+    Stream non-empty data lines from the API.
+
+    Raises on HTTP or network errors, and ValueError when the API answers
+    with an error message instead of data.
+    """
     params = {"id": f"00{device_id}", "ln": lines, "zm": zoom}
-    resp = requests.get(API_URL, params=params, timeout=30)
-    resp.raise_for_status()
-    return resp.text.strip()
+    with _SESSION.get(API_URL, params=params, timeout=30, stream=True) as resp:
+        resp.raise_for_status()
+        encoding = resp.encoding or "utf-8"
+        first = True
+        # Filter on the raw bytes; only lines that survive get decoded
+        for line in resp.iter_lines(chunk_size=8192):
+            line = line.strip()
+            if not line:
+                continue
+            if line in _API_ERRORS_B:
+                # The API may return a single-line error message
+                if first:
+                    raise ValueError(f"API reported: {line.decode(encoding)}")
+                continue
+            first = False
+            yield line.decode(encoding)
 
 
 def _parse_timestamp(parts: list[str]) -> Optional[str]:
     """Build an ISO-8601 timestamp from fields 0–5 (YY;MM;DD;HH;MM;SS)."""
     try:
-        dt = datetime(
-            year=2000 + int(parts[0]),
-            month=int(parts[1]),
-            day=int(parts[2]),
-            hour=int(parts[3]),
-            minute=int(parts[4]),
-            second=int(parts[5]),
-        )
-        return dt.isoformat()
+        year = 2000 + int(parts[0])
+        month, day = int(parts[1]), int(parts[2])
+        hour, minute, second = int(parts[3]), int(parts[4]), int(parts[5])
     except (ValueError, IndexError):
         return None
 
+    # Formatted directly instead of building a datetime per line; the range
+    # check rejects the same impossible dates datetime() would.
+    if not (
+        1 <= month <= 12 and 1 <= day <= monthrange(year, month)[1]
+        and 0 <= hour < 24 and 0 <= minute < 60 and 0 <= second < 60
+    ):
+        return None
+    return f"{year:04d}-{month:02d}-{day:02d}T{hour:02d}:{minute:02d}:{second:02d}"
+
+
+# Sensor readings repeat a lot ("23.5", "51", …); a cache hit beats float()
+_cached_float = lru_cache(maxsize=2048)(float)
+
+
+def _to_float(raw_val: str) -> Optional[float]:
+    """Convert one value, mapping non-numeric and non-finite input to None."""
+    try:
+        value = _cached_float(raw_val)
+    except ValueError:
+        return None
+    return value if isfinite(value) else None
+
 
-def parse_line(line: str, field_names: list[str]) -> Optional[dict]:
+class Parsed(NamedTuple):
+    """One parsed record; values are positional and named only at insert time."""
+    ts: str
+    raw: str
+    values: tuple[Optional[float], ...]
+
+
+def _column_names(field_names: list[str], count: int) -> list[str]:
+    """Return names for `count` values, naming columns beyond field_names field_<i>."""
+    return list(field_names) + [f"field_{i}" for i in range(len(field_names), count)]
+
+
+def parse_line(line: str) -> Optional[Parsed]:
     """
     Parse one semicolon-delimited CSV line.
 
-    Returns a dict:
-        {
-            "timestamp": "<ISO string>",
-            "raw_line":  "<original line>",
-            "fields":    [{"name": str, "value": float | None}, ...],
-        }
+    Returns Parsed(ts="<ISO string>", raw="<original line>", values=(float | None, ...)).
     Returns None for empty lines, API error strings, or malformed records.
     """
     line = line.strip()
     if not line or line in API_ERRORS:
         return None
 
-    parts = [p.strip() for p in line.split(";")]
+    # float()/int() ignore surrounding whitespace, so tokens need no strip()
+    parts = line.split(";")
 
     # Need at least: 6 timestamp fields + module_id + 1 measurement value
     if len(parts) < 8:
@@ -263,19 +398,19 @@ def parse_line(line: str, field_names: list[str]) -> Optional[dict]:
     # parts[6]  = module ID (skip)
     # parts[7:] = measurement values (strip trailing empty from trailing ";")
     value_parts = parts[7:]
-    if value_parts and value_parts[-1] == "":
-        value_parts = value_parts[:-1]
+    if value_parts and not value_parts[-1].strip():
+        value_parts.pop()
 
-    fields: list[dict] = []
-    for i, raw_val in enumerate(value_parts):
-        name = field_names[i] if i < len(field_names) else f"field_{i}"
-        try:
-            value: Optional[float] = float(raw_val)
-        except ValueError:
-            value = None
-        fields.append({"name": name, "value": value})
+    try:
+        # Fast path: the whole row converts in one C-level map()
+        values: tuple[Optional[float], ...] = tuple(map(_cached_float, value_parts))
+        # float() accepts "nan"/"inf", which are not valid JSON; store NULL
+        if not all(map(isfinite, values)):
+            values = tuple(_to_float(v) for v in value_parts)
+    except ValueError:
+        values = tuple(_to_float(v) for v in value_parts)
 
-    return {"timestamp": ts, "raw_line": line, "fields": fields}
+    return Parsed(ts, line, values)
 
 # ──────────────────────────────────────────────────────────────────────────────
 # DOWNLOAD & STORE
@@ -291,51 +426,46 @@ def download_device(device: dict) -> None:
     rows_inserted = 0
 
     try:
-        raw = fetch_raw(device_id)
-
-        # The API may return a single-line error message
-        if raw in API_ERRORS:
-            raise ValueError(f"API reported: {raw}")
-
-        text_lines = [ln for ln in raw.splitlines() if ln.strip()]
-        rows_fetched = len(text_lines)
-        log.info("  Fetched %d lines", rows_fetched)
+        # Parse lines as they arrive so the database sees one bulk statement
+        # instead of one round trip per record. One Parsed is kept per
+        # timestamp (first wins, as the insert would decide). The download
+        # finishes before the write transaction opens, so the lock is never
+        # held across network I/O.
+        by_ts: dict[str, Parsed] = {}
+        debug = log.isEnabledFor(logging.DEBUG)
+        for text_line in fetch_lines(device_id):
+            rows_fetched += 1
+
+            parsed = parse_line(text_line)
+            if parsed is None:
+                if debug:
+                    log.debug("  [%s] Skipping unparseable line: %r", alias, text_line)
+                continue
+            by_ts.setdefault(parsed.ts, parsed)
+
+        log.info("  [%s] Fetched %d lines", alias, rows_fetched)
+
+        names = _column_names(
+            field_names, max((len(p.values) for p in by_ts.values()), default=0)
+        )
 
         with db_conn() as conn:
-            _upsert_device(conn, device_id, alias)
-
-            for text_line in text_lines:
-                parsed = parse_line(text_line, field_names)
-                if parsed is None:
-                    log.debug("  Skipping unparseable line: %r", text_line)
-                    continue
-
-                try:
-                    cur = conn.execute(
-                        """
-                        INSERT INTO measurements (device_id, timestamp, raw_line)
-                        VALUES (?, ?, ?)
-                        """,
-                        (device_id, parsed["timestamp"], parsed["raw_line"]),
-                    )
-                    meas_id = cur.lastrowid
-                    rows_inserted += 1
-                    conn.executemany(
-                        """
-                        INSERT INTO measurement_fields
-                            (measurement_id, field_name, field_value)
-                        VALUES (?, ?, ?)
-                        """,
-                        [(meas_id, f["name"], f["value"]) for f in parsed["fields"]],
-                    )
-                except sqlite3.IntegrityError:
-                    # Duplicate (device_id, timestamp) — already stored, skip silently
-                    pass
+            # Duplicate (device_id, timestamp) — already stored, skip silently
+            before = conn.total_changes
+            conn.executemany(
+                _SQL_INS_MEAS,
+                (
+                    (device_id, p.ts, p.raw, json.dumps(dict(zip(names, p.values)), allow_nan=False))
+                    for p in by_ts.values()
+                ),
+            )
+            rows_inserted = conn.total_changes - before
 
             _log_run(conn, device_id, rows_fetched, rows_inserted, "ok")
 
         log.info(
-            "  Inserted %d new rows (%d duplicates skipped)",
+            "  [%s] Inserted %d new rows (%d duplicates skipped)",
+            alias,
             rows_inserted,
             rows_fetched - rows_inserted,
         )
@@ -347,16 +477,29 @@ def download_device(device: dict) -> None:
             with db_conn() as conn:
                 _log_run(conn, device_id, rows_fetched, rows_inserted, status)
         except Exception as db_exc:
-            log.error("  Could not write error to download_log: %s", db_exc)
+            log.error("  [%s] Could not write error to download_log: %s", alias, db_exc)
 
 
 def download_all() -> None:
     log.info("=== Download run started at %s ===", datetime.now().isoformat(timespec="seconds"))
-    for device in load_devices():
-        try:
-            download_device(device)
-        except Exception as exc:
-            log.error("Unexpected error for device '%s': %s", device.get("alias"), exc)
+    devices = load_devices()
+    # Registered per run rather than once in init_db(), so devices added to
+    # the device file while the scheduler is running are picked up too.
+    # A failure here must not stop the run; an unregistered device then
+    # fails its own insert and is recorded in download_log.
+    try:
+        _register_devices(devices)
+    except sqlite3.Error as exc:
+        log.error("Could not register devices: %s", exc)
+    # Downloads are network-bound; each worker opens its own connection and
+    # WAL + busy_timeout serialise the short write transactions.
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(devices)))) as ex:
+        futures = {ex.submit(download_device, device): device for device in devices}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as exc:
+                log.error("Unexpected error for device '%s': %s", futures[future].get("alias"), exc)
     log.info("=== Download run finished ===")
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -406,18 +549,11 @@ def cmd_query(alias: str) -> None:
 
         rows = conn.execute(
             """
-            WITH latest AS (
-                SELECT id
-                FROM   measurements
-                WHERE  device_id = ?
-                ORDER  BY timestamp DESC
-                LIMIT  10
-            )
-            SELECT m.timestamp, mf.field_name, mf.field_value
-            FROM   measurements m
-            JOIN   measurement_fields mf ON mf.measurement_id = m.id
-            WHERE  m.id IN (SELECT id FROM latest)
-            ORDER  BY m.timestamp DESC, mf.field_name
+            SELECT timestamp, field_values
+            FROM   measurements
+            WHERE  device_id = ?
+            ORDER  BY timestamp DESC
+            LIMIT  10
             """,
             (device["device_id"],),
         ).fetchall()
@@ -427,13 +563,11 @@ def cmd_query(alias: str) -> None:
         return
 
     print(f"Last 10 measurements for '{alias}':\n")
-    current_ts: Optional[str] = None
     for r in rows:
-        if r["timestamp"] != current_ts:
-            current_ts = r["timestamp"]
-            print(f"  {current_ts}")
-        value_str = f"{r['field_value']:.4g}" if r["field_value"] is not None else "(null)"
-        print(f"    {r['field_name']:<24} {value_str}")
+        print(f"  {r['timestamp']}")
+        for name, value in json.loads(r["field_values"]).items():
+            value_str = f"{value:.4g}" if value is not None else "(null)"
+            print(f"    {name:<24} {value_str}")
 
 # ──────────────────────────────────────────────────────────────────────────────
 # ENTRY POINT
@@ -486,9 +620,16 @@ def main() -> None:
     getattr(schedule.every(), SCHEDULE_DAY).at(SCHEDULE_TIME).do(download_all)
 
     try:
+        # Sleep until the next job instead of polling every 30 s. Each nap is
+        # capped at an hour: time.sleep() does not advance during suspend while
+        # schedule uses wall-clock time, so a week-long sleep could fire late.
         while True:
+            idle = schedule.idle_seconds()
+            if idle is None:
+                break
+            if idle > 0:
+                time.sleep(min(idle, 3600))
             schedule.run_pending()
-            time.sleep(30)
     except KeyboardInterrupt:
         log.info("Scheduler stopped by user.")
 